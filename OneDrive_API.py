@@ -1,12 +1,22 @@
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
 import json
 import os
 import requests
+from requests.adapters import HTTPAdapter
 from selenium import webdriver
-from threading import Thread, Lock
+from selenium.webdriver.support.ui import WebDriverWait
+from threading import RLock
 import time
 from typing import Any, Type
 import urllib
+from urllib3.util import Retry
+
+try:
+    import orjson # faster parsing of large responses (e.g. folder listings), if available
+except ImportError:
+    orjson = None
 
 
 class OneDrive:
@@ -18,8 +28,9 @@ class OneDrive:
         :param connection_parameters: Holds all parameters necessary for connecting to OneDrive
         """
         # the following variables are set with a settings file
-        self.mutex = Lock() # mutex
-        self.threads = [] # here the running threads are saved
+        self.token_mutex = RLock() # guards the access token and the connection state, so that concurrent threads only refresh the token once
+        self._session = requests.Session() # keeps the connections to OneDrive alive between requests
+        self._executor: ThreadPoolExecutor = None # worker threads used for communicating to OneDrive
         self.max_threads: int = 0 # maximum number of threads used for communicating to OneDrive
         self.refresh_token: str = "" # used for granting a new access token
         self.refresh_token_url: str = "" # used for granting a new refresh token
@@ -29,26 +40,36 @@ class OneDrive:
         self.permissions: list = [] # permissions as str
         self.redirect_uri: str = "" # redirect URL
         self.scope = '' # holds the permissions
-        self.refresh_interval: int = 0 # interval (in seconds) after which the API connection has to be refreshed
-        self.number_retry_connection: int = 0 # number of retrys to be executed to connect to the API
+        self.refresh_interval: int = 0 # interval (in seconds) after which the API connection has to be refreshed, if the lifetime of the access token is not returned
+        self.number_retry_connection: int = 0 # number of retrys of a request to the API on connection errors or transient server errors (with exponential backoff)
+        self.simple_upload_limit: int = 4 * 1024 * 1024 # files of at least this size (in bytes) are uploaded in chunks via an upload session
+        self.upload_chunk_size: int = 10 * 1024 * 1024 # size (in bytes) of the chunks uploaded via an upload session, has to be a multiple of 320 KiB
+        self.download_chunk_size: int = 1024 * 1024 # size (in bytes) of the chunks written to drive while downloading
+        self.batch_size: int = 20 # maximum number of requests combined in one batch request
+        self.authorization_timeout: int = 600 # time (in seconds) the user has to grant access in the browser
 
         # the following variables are dependent on the previous ones or are derived from them
         self.token: str = "" # actual token
-        self.last_updated: float = 0.0 # timestamp since last connection check
+        self.expiry_buffer: int = 300 # time (in seconds) before the expiry of the access token at which it is refreshed
+        self._expires_at: float = 0.0 # timestamp at which the access token has to be refreshed
         self.headers: dict = dict() # holds the token
-        self.errors: list = [] # error descriptions
+        self.errors: deque = deque() # error descriptions; appending and popping is thread-safe without a lock
         self.is_connected = False # specifies if a connection to OneDrive is available
         self.refresh_token_updated = False # specifies if a new refresh token was granted. If this is True, the value of 'refresh_token' could be saved to local drive (where all the other data for OneDrive is stored)
 
         self._SetParameters(connection_parameters)
+        self._MountAdapter()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_threads)
         self._CheckConnected()
 
 
     def __del__(self) -> None:
         """
-        Destructor. Ensures all running threads are joined.
+        Destructor. Stops the worker threads and closes the connections. The worker threads are not joined, since the destructor may be called on one of them.
         """
-        self._JoinThreads()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self._session.close()
 
 
     def _SetsAndChecksVariable(self, parameters: dict, var: str, var_type: Type, member_var_name: str) -> None:
@@ -98,17 +119,24 @@ class OneDrive:
             self._SetsAndChecksVariable(parameters, "redirect_uri", str, "redirect_uri")
 
             self._SetsAndChecksVariableWithDefaultValue(parameters, "refresh_interval", 3600, int, "refresh_interval")
-            self._SetsAndChecksVariableWithDefaultValue(parameters, "number_retry_connection", 50, int, "number_retry_connection")
+            self._SetsAndChecksVariableWithDefaultValue(parameters, "number_retry_connection", 5, int, "number_retry_connection")
 
-            self.scope = ''
-            for items in range(len(self.permissions)):
-                self.scope = self.scope + self.permissions[items]
-                if items < len(self.permissions) - 1:
-                    self.scope = self.scope + '+'
+            self.scope = '+'.join(self.permissions)
         except Exception as ex:
             raise Exception("Could not initialize parameters: " + str(ex))
 
 
+    def _MountAdapter(self) -> None:
+        """
+        Sizes the connection pool of the session, so that all worker threads can share the connections to OneDrive, and sets up retrying failed requests
+        """
+        retry = Retry(total=self.number_retry_connection, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                      respect_retry_after_header=True, raise_on_status=False,
+                      allowed_methods=frozenset(['GET', 'POST', 'PUT', 'PATCH', 'DELETE']))
+        adapter = HTTPAdapter(pool_connections=self.max_threads, pool_maxsize=self.max_threads * 2, max_retries=retry)
+        self._session.mount("https://", adapter)
+
+
     def _SaveRequest(func: callable) -> callable:
         """
         Decorator for all functions usable in public scope.
@@ -123,13 +151,36 @@ class OneDrive:
         return Wrapper
 
 
+    def _Request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a request to OneDrive authorized with the current access token. All requests to the browse URL are sent via this function
+        :param method: http method (e.g. 'GET')
+        :param url: URL to send the request to
+        :param kwargs: further arguments passed to the request (e.g. 'json', 'data')
+        :return: http-response
+        """
+        token = self.token
+        response = self._session.request(method, url, **kwargs)
+        if response.status_code == 401:
+            # the access token was invalidated before its expiry: acquire a new one and retry once
+            response.close()
+            with self.token_mutex:
+                if self.token == token:
+                    self._expires_at = 0.0
+                    self._CheckLastHeartbeat()
+            if hasattr(kwargs.get("data"), "seek"):
+                kwargs["data"].seek(0)
+            response = self._session.request(method, url, **kwargs)
+        return response
+
+
     @_SaveRequest
     def _Connect(self) -> None:
         """
         Connects to the OneDriveAPI
         """
         self._RefreshToken()
-        response = requests.get(self.url + 'me/drive/', headers=self.headers)
+        response = self._Request("GET", self.url + 'me/drive/')
         if response.status_code == 200:
             self.is_connected = True
         else:
@@ -149,7 +200,7 @@ class OneDrive:
             "grant_type": 'refresh_token'
         }
         response = requests.post(self.auth_url, data=data)
-        response_data = json.loads(response.text)
+        response_data = self._ParseResponse(response)
         if not "access_token" in response_data.keys():
             if response_data["error"] == "invalid_grant":
                 self._UpdateRefreshToken()
@@ -158,8 +209,9 @@ class OneDrive:
         else:
             self.token = response_data["access_token"]
             self.refresh_token = response_data["refresh_token"]
-        self.last_updated = time.mktime(datetime.today().timetuple())
+            self._SetExpiry(response_data)
         self.headers = {'Authorization': 'Bearer ' + self.token}
+        self._session.headers.update(self.headers)
 
 
     def _UpdateRefreshToken(self):
@@ -175,13 +227,12 @@ class OneDrive:
         driver.get(URL)
 
         try:
-            while True:
-                current_url = driver.current_url
-                if self.redirect_uri + "?code=" in current_url:
-                    driver.quit()
-                    break
+            WebDriverWait(driver, self.authorization_timeout).until(lambda driver: self.redirect_uri + "?code=" in driver.current_url)
+            current_url = driver.current_url
         except:
             raise Exception("Could not refresh access token")
+        finally:
+            driver.quit()
         code = current_url[(current_url.find('?code') + len('?code') + 1):]
 
         # Get token
@@ -193,34 +244,42 @@ class OneDrive:
             "grant_type": 'authorization_code'
         }
         response = requests.post(self.auth_url, data=data)
-        self.refresh_token = json.loads(response.text)["refresh_token"]
-        self.token = json.loads(response.text)["access_token"]
+        response_data = self._ParseResponse(response)
+        self.refresh_token = response_data["refresh_token"]
+        self.token = response_data["access_token"]
+        self._SetExpiry(response_data)
         self.refresh_token_updated = True
 
 
+    def _SetExpiry(self, response_data: dict) -> None:
+        """
+        Sets the timestamp at which the access token has to be refreshed
+        :param response_data: response of the authentication URL holding the lifetime of the access token (in seconds)
+        """
+        lifetime = int(response_data.get("expires_in", self.refresh_interval))
+        # for short lifetimes the buffer must not move the expiry into the past
+        self._expires_at = time.time() + max(lifetime - self.expiry_buffer, lifetime / 2)
+
+
     def _CheckLastHeartbeat(self) -> None:
         """
         Checks if the connection has to be refreshed
         """
-        now = time.mktime(datetime.today().timetuple())
-        if now - self.last_updated > self.refresh_interval:
-            self._RefreshToken()
+        with self.token_mutex:
+            if time.time() >= self._expires_at:
+                self._RefreshToken()
 
 
     def _CheckConnected(self) -> None:
         """
         Checks if the connection to the API is active
         """
-        attempts = 0
-        if not self.is_connected:
-            while not self.is_connected:
-                attempts += 1
-                if attempts == self.number_retry_connection:
-                    raise Exception("Could not connect to OneDrive")
+        with self.token_mutex:
+            if not self.is_connected:
                 self._Connect()
-                time.sleep(0.5)
-        self._CheckLastHeartbeat()
-        self._CheckRequestsCompleted()
+                if not self.is_connected:
+                    raise Exception("Could not connect to OneDrive")
+            self._CheckLastHeartbeat()
 
 
     def _CheckError(self, error_text: str, response: Any) -> bool:
@@ -231,18 +290,16 @@ class OneDrive:
         :return: True, if an error occurred
         """
         error_occurred = False
-        if type(response).__name__ == "Response":
+        if isinstance(response, requests.Response):
             error_occurred = not response.ok
-        elif type(response).__name__ == "dict":
-            for key in response:
-                if "error" in key:
-                    error_occurred = True
-                    error_text = error_text + " (Code: " + response["error"]["code"] + ")"
+        elif isinstance(response, dict):
+            if "error" in response:
+                error_occurred = True
+                error_text = error_text + " (Code: " + response["error"]["code"] + ")"
         else:
             error_occurred = True
         if error_occurred:
-            with self.mutex:
-                self.errors.append(error_text)
+            self.errors.append(error_text)
         return error_occurred
 
 
@@ -251,31 +308,81 @@ class OneDrive:
         Fetches all error messages saved in 'CheckError'
         :param prefix: Prefix to be prepended to the error messages saved
         """
-        with self.mutex:
-            if len(self.errors) != 0:
-                error_text = ". ".join(self.errors)
-                self.errors = []
-                error_text = prefix + error_text
-                raise Exception(error_text)
+        errors = []
+        while len(self.errors) != 0:
+            errors.append(self.errors.popleft())
+        if len(errors) != 0:
+            error_text = prefix + ". ".join(errors)
+            raise Exception(error_text)
+
+
+    def _ParseResponse(self, response: requests.Response) -> Any:
+        """
+        Parses the json body of a response from OneDrive
+        :param response: http-response to parse
+        :return: parsed body
+        """
+        if orjson is not None:
+            return orjson.loads(response.content)
+        return json.loads(response.content)
+
+
+    def _RootUrl(self, path_onedrive: str, suffix: str) -> str:
+        """
+        Builds the URL of an item in OneDrive addressed by its path
+        :param path_onedrive: path of the item relative to the root of OneDrive
+        :param suffix: appended to the path (e.g. ':/children')
+        :return: URL
+        """
+        return self.url + "me/drive/root:/" + path_onedrive.strip("/") + suffix
+
+
+    def _Batch(self, requests_list: list) -> list:
+        """
+        Sends several requests combined in batch requests, so that only one round-trip per 'batch_size' requests is necessary
+        :param requests_list: requests given as dict with the keys 'method', 'url' (relative to the browse URL, e.g. '/me/drive/items/...') and optionally 'body'
+        :return: responses given as dict with the keys 'status' and 'body' in the order of 'requests_list'. If a whole batch request fails, the body of each of its responses holds the error
+        """
+        responses = []
+        for start in range(0, len(requests_list), self.batch_size):
+            batch = []
+            for index, request in enumerate(requests_list[start:start + self.batch_size]):
+                request = dict(request, id=str(index))
+                if "body" in request:
+                    request["headers"] = {"Content-Type": "application/json"}
+                batch.append(request)
+            response = self._ParseResponse(self._Request("POST", self.url + "$batch", json={"requests": batch}))
+            if "error" in response:
+                responses.extend({"id": request["id"], "status": None, "body": response} for request in batch)
+                continue
+            responses.extend(sorted(response["responses"], key=lambda item: int(item["id"])))
+        return responses
 
 
-    def _JoinThreads(self) -> None:
+    def _FetchConcurrently(self, *urls: str) -> list:
         """
-        Joins all active threads
+        Sends GET requests to several URLs concurrently. The responses are not checked for errors, as this has to be done by the calling thread
+        :param urls: URLs to fetch
+        :return: parsed responses in the order of 'urls'
         """
-        number_threads = len(self.threads)
-        for i in range(number_threads):
-            thread = self.threads[0]
-            thread.join()
-            self.threads.pop(0)
+        futures = [self._executor.submit(self._Request, "GET", url) for url in urls]
+        return [self._ParseResponse(future.result()) for future in futures]
 
 
-    def _CheckRequestsCompleted(self) -> None:
+    def _SplitItems(self, response: dict) -> tuple:
         """
-        Lets the main thread wait, until all worker threads are completed
+        Splits the children of a folder into files and folders
+        :param response: parsed response of a request to the children of a folder
+        :return: tuple: first element: dictionary of all files (key: filename, value: OneDrive-ID), second element: dictionary of all folders (key: foldername, value: OneDrive-ID)
         """
-        while len(self.threads) > 0:
-            time.sleep(0.1)
+        results_files = dict()
+        results_folder = dict()
+        for item in response["value"]:
+            if "folder" in item:
+                results_folder[item["name"]] = item["id"]
+            else:
+                results_files[item["name"]] = item["id"]
+        return results_files, results_folder
 
 
     @_SaveRequest
@@ -286,9 +393,9 @@ class OneDrive:
         :return: OneDrive-ID
         """
         self._CheckConnected()
-        path_onedrive = path_onedrive.lstrip("/").rstrip("/")
-        url = self.url + "me/drive/root:/" + path_onedrive + "/"
-        response = json.loads(requests.get(url, headers=self.headers).text)
+        path_onedrive = path_onedrive.strip("/")
+        url = self._RootUrl(path_onedrive, "/")
+        response = self._ParseResponse(self._Request("GET", url))
         error_message = "Could not fetch the folder ID of " + path_onedrive
         self._CheckError(error_message, response)
         self._FetchErrors()
@@ -303,20 +410,13 @@ class OneDrive:
         :return: tuple: first element: dictionary of all files (key: filename, value: OneDrive-ID), second element: dictionary of all folders (key: foldername, value: OneDrive-ID)
         """
         self._CheckConnected()
-        path_onedrive = path_onedrive.lstrip("/").rstrip("/")
-        url = self.url + "me/drive/root:/" + path_onedrive + ":/children"
-        response = json.loads(requests.get(url, headers=self.headers).text)
-        results_files = dict()
-        results_folder = dict()
+        path_onedrive = path_onedrive.strip("/")
+        url = self._RootUrl(path_onedrive, ":/children")
+        response = self._ParseResponse(self._Request("GET", url))
         error_message = "Could not fetch all files from " + path_onedrive
         self._CheckError(error_message, response)
         self._FetchErrors()
-        for item in response["value"]:
-            if "folder" in item.keys():
-                results_folder[item["name"]] = item["id"]
-            else:
-                results_files[item["name"]] = item["id"]
-        return results_files, results_folder
+        return self._SplitItems(response)
 
 
     @_SaveRequest
@@ -327,14 +427,14 @@ class OneDrive:
         :param new_folder_name: new folder name
         """
         self._CheckConnected()
-        path_onedrive = path_onedrive.lstrip("/").rstrip("/")
-        url = self.url + "me/drive/root:/" + path_onedrive + ":/children"
+        path_onedrive = path_onedrive.strip("/")
+        url = self._RootUrl(path_onedrive, ":/children")
         body = {
             "name": new_folder_name,
             "folder": {},
             "@microsoft.graph.conflictBehavior": "fail"
         }
-        response = json.loads(requests.post(url, headers=self.headers, json=body).text)
+        response = self._ParseResponse(self._Request("POST", url, json=body))
         error_message = "Could not create the directory " + new_folder_name
         self._CheckError(error_message, response)
         self._FetchErrors()
@@ -349,24 +449,63 @@ class OneDrive:
         :param arg_filename: filename to be moved
         """
         self._CheckConnected()
-        dest_path_onedrive = dest_path_onedrive.lstrip("/").rstrip("/")
-        src_path_onedrive = src_path_onedrive.lstrip("/").rstrip("/")
-        files_ids, _ = self.FetchAllFiles(src_path_onedrive)
-        dest_path_id = self._FetchFolderID(dest_path_onedrive)
-        for filename in files_ids:
-            if filename == arg_filename:
-                file_id = files_ids[filename]
-                url = self.url + 'me/drive/items/' + file_id
-                body = {
-                    "parentReference": {
-                        "id": dest_path_id
-                    },
-                }
-                response = json.loads(requests.patch(url, headers=self.headers, json=body).text)
-                error_message = "Could not move file " + src_path_onedrive
-                self._CheckError(error_message, response)
-                self._FetchErrors()
-                return
+        dest_path_onedrive = dest_path_onedrive.strip("/")
+        src_path_onedrive = src_path_onedrive.strip("/")
+        # both lookups are independent of each other and therefore sent concurrently
+        response, dest_response = self._FetchConcurrently(self._RootUrl(src_path_onedrive + "/" + urllib.parse.quote(arg_filename), ""),
+                                                          self._RootUrl(dest_path_onedrive, "/"))
+        error_message = "Could not move file " + arg_filename
+        self._CheckError(error_message + ": File does not exist", response)
+        self._CheckError("Could not fetch the folder ID of " + dest_path_onedrive, dest_response)
+        self._FetchErrors()
+        file_id = response["id"]
+        dest_path_id = dest_response["id"]
+        url = self.url + 'me/drive/items/' + file_id
+        body = {
+            "parentReference": {
+                "id": dest_path_id
+            },
+        }
+        response = self._ParseResponse(self._Request("PATCH", url, json=body))
+        self._CheckError(error_message, response)
+        self._FetchErrors()
+
+
+    @_SaveRequest
+    def MoveFiles(self, dest_path_onedrive: str, src_path_onedrive: str, filenames: list) -> None:
+        """
+        Moves several files between directorys in OneDrive. The files are moved using batch requests
+        :param dest_path_onedrive: directory to move the files to (e.g. if there is a directory 'Test' on the main page of OneDrive (=root), let 'path_onedrive' be 'Test/')
+        :param src_path_onedrive: directory where the files are located (e.g. if there is a directory 'Test' on the main page of OneDrive (=root), let 'path_onedrive' be 'Test/')
+        :param filenames: filenames to be moved
+        """
+        self._CheckConnected()
+        dest_path_onedrive = dest_path_onedrive.strip("/")
+        src_path_onedrive = src_path_onedrive.strip("/")
+        files_response, dest_response = self._FetchConcurrently(self._RootUrl(src_path_onedrive, ":/children"),
+                                                                self._RootUrl(dest_path_onedrive, "/"))
+        self._CheckError("Could not fetch all files from " + src_path_onedrive, files_response)
+        self._CheckError("Could not fetch the folder ID of " + dest_path_onedrive, dest_response)
+        self._FetchErrors()
+        files_ids, _ = self._SplitItems(files_response)
+        dest_path_id = dest_response["id"]
+        body = {
+            "parentReference": {
+                "id": dest_path_id
+            },
+        }
+        moved_files = []
+        requests_list = []
+        for filename in filenames:
+            if not filename in files_ids:
+                self._CheckError("Could not move " + filename + ": File does not exist", None)
+                continue
+            moved_files.append(filename)
+            requests_list.append({"method": "PATCH", "url": "/me/drive/items/" + files_ids[filename], "body": body})
+        responses = self._Batch(requests_list)
+        for filename, response in zip(moved_files, responses):
+            self._CheckError("Could not move " + filename, response.get("body", dict()))
+        self._FetchErrors("Could not move all files: ")
 
 
     @_SaveRequest
@@ -377,22 +516,131 @@ class OneDrive:
         :param src_path_onedrive: directory where all file are located (e.g. if there is a directory 'Test' on the main page of OneDrive (=root), let 'path_onedrive' be 'Test/')
         """
         self._CheckConnected()
-        dest_path_onedrive = dest_path_onedrive.lstrip("/").rstrip("/")
-        src_path_onedrive = src_path_onedrive.lstrip("/").rstrip("/")
-        src_path_id = self._FetchFolderID(src_path_onedrive)
-        dest_path_id = self._FetchFolderID(dest_path_onedrive)
+        dest_path_onedrive = dest_path_onedrive.strip("/")
+        src_path_onedrive = src_path_onedrive.strip("/")
+        src_response, dest_response = self._FetchConcurrently(self._RootUrl(src_path_onedrive, "/"),
+                                                              self._RootUrl(dest_path_onedrive, "/"))
+        self._CheckError("Could not fetch the folder ID of " + src_path_onedrive, src_response)
+        self._CheckError("Could not fetch the folder ID of " + dest_path_onedrive, dest_response)
+        self._FetchErrors()
+        src_path_id = src_response["id"]
+        dest_path_id = dest_response["id"]
         url = self.url + 'me/drive/items/' + src_path_id
         body = {
             "parentReference": {
                 "id": dest_path_id
             },
         }
-        response = json.loads(requests.patch(url, headers=self.headers, json=body).text)
+        response = self._ParseResponse(self._Request("PATCH", url, json=body))
         error_message = "Could not move all files from " + src_path_onedrive
         self._CheckError(error_message, response)
         self._FetchErrors()
 
 
+    def _UploadSession(self, content: Any, file_size: int, url: str) -> dict:
+        """
+        Uploads a file in chunks via an upload session. This is necessary for files larger than 4 MB
+        :param content: opened file to upload
+        :param file_size: size of the file (in bytes)
+        :param url: URL of the file to upload in OneDrive (without ':/content')
+        :return: the response of the last request sent (the uploaded item or an error)
+        """
+        response = self._ParseResponse(self._Request("POST", url + ":/createUploadSession"))
+        if "error" in response:
+            return response
+        upload_url = response["uploadUrl"]
+        # the upload URL is pre-authenticated, sending the access token along may be rejected
+        header = {'Authorization': None}
+        start = 0
+        while start < file_size:
+            chunk = content.read(self.upload_chunk_size)
+            if not chunk:
+                break
+            end = start + len(chunk) - 1
+            header['Content-Range'] = 'bytes ' + str(start) + '-' + str(end) + '/' + str(file_size)
+            response = self._ParseResponse(self._session.put(upload_url, headers=header, data=chunk))
+            if "error" in response:
+                self._session.delete(upload_url, headers={'Authorization': None})
+                return response
+            start = end + 1
+        return response
+
+
+    def _WaitForWorkers(self, futures: dict) -> None:
+        """
+        Waits until all tasks submitted to the worker threads are completed and saves their exceptions as errors. If waiting is interrupted, the tasks not yet started are cancelled
+        :param futures: submitted tasks (key: future, value: error message used, if the task raised an exception)
+        """
+        try:
+            wait(futures)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+        for future, error_message in futures.items():
+            exception = future.exception()
+            if exception is not None:
+                self._CheckError(error_message + ": " + (str(exception) or type(exception).__name__), None)
+
+
+    def _UploadIntern(self, filename: str, url: str, log: bool) -> bool:
+        """
+        Uploads a single file. Executed by the worker threads
+        :param filename: file to upload (given as local path)
+        :param url: URL of the file to upload in OneDrive (without ':/content')
+        :param log: writes to console, if the file is uploaded
+        :return: True, if an error occurred
+        """
+        if not os.path.isfile(filename):
+            error_message = "Could not upload " + filename + ": File does not exist"
+            self._CheckError(error_message, None)
+            return True
+        file_size = os.path.getsize(filename)
+        with open(filename, 'rb') as content:
+            if file_size < self.simple_upload_limit:
+                response = self._ParseResponse(self._Request("PUT", url + ":/content", data=content))
+            else:
+                response = self._UploadSession(content, file_size, url)
+        error_message = "Could not upload " + filename
+        error_occured = self._CheckError(error_message, response)
+        if log and not error_occured:
+            print("File " + filename + " has been uploaded")
+        return error_occured
+
+
+    def _DownloadIntern(self, path_local: str, filename: str, url: str, log: bool) -> bool:
+        """
+        Downloads a single file. Executed by the worker threads
+        :param path_local: local directory to download to
+        :param filename: name of the file to download
+        :param url: URL of the content of the file in OneDrive
+        :param log: writes to console, if the file is downloaded
+        :return: True, if an error occurred
+        """
+        error_message = "Could not download " + filename
+        path_file = path_local + "/" + filename
+        with self._Request("GET", url, stream=True) as data:
+            if self._CheckError(error_message, data):
+                return True
+            try:
+                with open(path_file, 'wb') as f:
+                    for chunk in data.iter_content(chunk_size=self.download_chunk_size):
+                        f.write(chunk)
+            except requests.RequestException as ex:
+                error_message = error_message + ": " + str(ex)
+            except:
+                error_message = "Could not write " + path_file + " to drive"
+            else:
+                if log:
+                    print("File " + filename + " has been downloaded")
+                return False
+        # do not leave a partially written file
+        if os.path.isfile(path_file):
+            os.remove(path_file)
+        self._CheckError(error_message, None)
+        return True
+
+
     @_SaveRequest
     def Upload(self, filenames: list, path_onedrive: str, log: bool = True) -> None:
         """
@@ -401,42 +649,19 @@ class OneDrive:
         :param path_onedrive: directory to upload to (e.g. if there is a directory 'Test' on the main page of OneDrive (=root), let 'path_onedrive' be 'Test/')
         :param log: writes to console, if files are uploaded
         """
-
-        def UploadIntern(filename, url, header, log, CheckError):
-            if not os.path.isfile(filename):
-                error_message = "Could not upload " + filename + ": File does not exist"
-                CheckError(error_message, None)
-                return True
-            content = open(filename, 'rb')
-            response = json.loads(requests.put(url, headers=header, data=content).text)
-            error_message = "Could not upload " + filename
-            error_occured = CheckError(error_message, response)
-            if log and not error_occured:
-                print("File " + filename + " has been uploaded")
-            return error_occured
-
         self._CheckConnected()
         if path_onedrive[0] != "/":
             path_onedrive = "/" + path_onedrive
         if path_onedrive[-1] != "/":
             path_onedrive = path_onedrive + "/"
-        url_pre = self.url + 'me/drive/root:'
-        url_post = ':/content'
-        index = len(filenames)
-        while index > 0:
-            number_threads = self.max_threads
-            if index < self.max_threads:
-                number_threads = index
-            for i in range(number_threads):
-                index -= 1
-                filename = filenames[index]
-                filename = filename.replace("\\", "/")
-                url = url_pre + path_onedrive + filename.split("/")[-1] + url_post
-                thread = Thread(target=UploadIntern, args=(filename, url, self.headers, log, self._CheckError,), daemon=True)
-                thread.start()
-                self.threads.append(thread)
-            self._JoinThreads()
-            self._FetchErrors("Could not upload all files: ")
+        url_pre = self.url + 'me/drive/root:' + path_onedrive
+        upload = partial(self._UploadIntern, log=log)
+        futures = dict()
+        for filename in filenames:
+            filename = filename.replace("\\", "/")
+            futures[self._executor.submit(upload, filename, url_pre + os.path.basename(filename))] = "Could not upload " + filename
+        self._WaitForWorkers(futures)
+        self._FetchErrors("Could not upload all files: ")
 
 
     @_SaveRequest
@@ -448,41 +673,16 @@ class OneDrive:
         :param specific_file: downloads only the given file; downloads all files from 'path_onedrive', when empty string is given
         :param log: writes to console, if files are downloaded
         """
-
-        def DownloadIntern(path_local, filename, url, header, log, CheckError):
-            data = requests.get(url, headers=header)
-            error_message = "Could not download " + filename
-            if CheckError(error_message, data):
-                return True
-            try:
-                with open(path_local + "/" + filename, 'wb') as f:
-                    f.write(data.content)
-                if log:
-                    print("File " + filename + " has been downloaded")
-                return False
-            except:
-                error_message = "Could not write " + path_local + " to drive"
-                CheckError(error_message, None)
-                return True
-
         self._CheckConnected()
         if not os.path.exists(path_local):
             os.makedirs(path_local)
-        path_onedrive = path_onedrive.lstrip("/").rstrip("/")
+        path_onedrive = path_onedrive.strip("/")
         all_files, _ = self.FetchAllFiles(path_onedrive)
-        keys = list(all_files.keys())
-        index = len(keys)
-        while index > 0:
-            number_threads = self.max_threads
-            if index < self.max_threads:
-                number_threads = index
-            for i in range(number_threads):
-                index -= 1
-                filename = keys[index]
-                if (specific_file != "" and specific_file == filename) or specific_file == "":
-                    url = self.url + 'me/drive/items/' + all_files[filename] + "/content"
-                    thread = Thread(target=DownloadIntern, args=(path_local, filename, url, self.headers, log, self._CheckError,), daemon=True)
-                    thread.start()
-                    self.threads.append(thread)
-            self._JoinThreads()
-            self._FetchErrors("Could not download all files: ")
+        download = partial(self._DownloadIntern, path_local, log=log)
+        url_pre = self.url + 'me/drive/items/'
+        futures = dict()
+        for filename, file_id in all_files.items():
+            if specific_file == "" or specific_file == filename:
+                futures[self._executor.submit(download, filename, url_pre + file_id + "/content")] = "Could not download " + filename
+        self._WaitForWorkers(futures)
+        self._FetchErrors("Could not download all files: ")